@@ -20,6 +20,7 @@
 
 import os
 import datetime
+import functools
 import re
 import subprocess
 
@@ -27,23 +28,57 @@
 HERE = os.path.dirname(__file__)
 
 #------------------------------------------------------------------------------
+_GIT_TAG_RE = re.compile(r'''
+    ^
+    (?P<major>\d+)\.
+    (?P<minor>\d+)\.
+    (?P<patch>\d+)
+    (\.post(?P<post>\d+))?
+    (-(?P<dev>\d+))?
+    (-g(?P<commit>.+))?
+    $
+    ''', re.VERBOSE)
+
+def _parse_git_tag(version):
+    base, sep, rest = version.partition('-')
+    d = {'post': None, 'dev': None, 'commit': None}
+
+    nums = base.split('.')
+    if len(nums) == 4 and nums[3].startswith('post'):
+        d['post'] = nums.pop()[4:]
+        if not d['post'].isdecimal():
+            return None
+    if len(nums) != 3 or not all(n.isdecimal() for n in nums):
+        return None
+    d['major'], d['minor'], d['patch'] = nums
+
+    if sep:
+        if rest.startswith('g'):
+            commit = rest
+        else:
+            d['dev'], sep, commit = rest.partition('-')
+            if not d['dev'].isdecimal():
+                return None
+            if not sep:
+                return d
+        if not commit.startswith('g') or len(commit) < 2:
+            return None
+        d['commit'] = commit[1:]
+
+    return d
+
+@functools.lru_cache(maxsize=128)
 def _tag_to_pep440_version(tag):
-    version = re.sub(r'^v', '', tag)
-
-    git_tag_re = re.compile(r'''
-        ^
-        (?P<major>\d+)\.
-        (?P<minor>\d+)\.
-        (?P<patch>\d+)
-        (\.post(?P<post>\d+))?
-        (-(?P<dev>\d+))?
-        (-g(?P<commit>.+))?
-        $
-        ''', re.VERBOSE)
-
-    match = git_tag_re.match(version)
-    if match:
-        d = match.groupdict()
+    version = tag[1:] if tag.startswith('v') else tag
+
+    # fast path, fall back on the regex for anything it does not handle
+    d = _parse_git_tag(version)
+    if d is None:
+        match = _GIT_TAG_RE.match(version)
+        if match:
+            d = match.groupdict()
+
+    if d is not None:
         fmt = '{major}.{minor}.{patch}'
         if d.get('post'):
             fmt += '.post.{post}'
@@ -55,20 +90,37 @@ def _tag_to_pep440_version(tag):
     return datetime.datetime.now().strftime('%Y.%m.%d')
 
 #------------------------------------------------------------------------------
-def _tag_from_git_describe():
-    if not os.path.isdir(os.path.join(HERE, '../.git')):
+def _git_dir():
+    dotgit = os.path.join(HERE, '../.git')
+    if os.path.isfile(dotgit):
+        # worktrees and submodules use a "gitdir: <path>" link file
+        with open(dotgit, 'r') as f:
+            line = f.readline().strip()
+        if not line.startswith('gitdir:'):
+            raise ValueError('invalid .git file')
+        return os.path.join(os.path.dirname(dotgit), line[7:].strip())
+    if not os.path.isdir(dotgit):
         raise ValueError('not in git repo')
+    return dotgit
+
+#------------------------------------------------------------------------------
+def _tag_from_git_describe():
+    _git_dir()  # raises ValueError if not in a git repo
 
+    # do not block forever on a stuck git process
     out = subprocess.check_output(['git', 'describe', '--always'],
-                                  cwd=HERE, stderr=subprocess.STDOUT)
+                                  cwd=HERE, stderr=subprocess.STDOUT,
+                                  timeout=2)
     return out.strip().decode('utf-8')
 
 #------------------------------------------------------------------------------
+_ARCHIVE_ID_RE = re.compile(r'tag:\s*v([^,)]+)')
+
 def _version_from_git_archive_id(git_archive_id='1540282465  (HEAD -> master)'):
     if git_archive_id.startswith('$For''mat:'):
         raise ValueError('not a git archive')
 
-    match = re.search(r'tag:\s*v([^,)]+)', git_archive_id)
+    match = _ARCHIVE_ID_RE.search(git_archive_id)
     if match:
         # archived revision is tagged, use the tag
         return _tag_to_pep440_version(match.group(1))
@@ -79,24 +131,73 @@ def _version_from_git_archive_id(git_archive_id='1540282465  (HEAD -> master)'):
     return d.strftime('%Y.%m.%d')
 
 #------------------------------------------------------------------------------
+def _git_common_dir(git_dir):
+    # linked worktrees share their refs with the main repository
+    try:
+        with open(os.path.join(git_dir, 'commondir'), 'r') as f:
+            return os.path.join(git_dir, f.read().strip())
+    except FileNotFoundError:
+        return git_dir
+
+def _version_file_is_stale(version_file):
+    try:
+        git_dir = _git_dir()
+        common_dir = _git_common_dir(git_dir)
+    except (OSError, ValueError):
+        # not in a git repo, the file cannot be refreshed anyway
+        return False
+
+    # the HEAD reflog is touched on every commit, checkout, reset, etc.
+    # tags are stored either as loose files under refs/tags or in packed-refs
+    paths = [
+        os.path.join(git_dir, 'logs/HEAD'),
+        os.path.join(git_dir, 'HEAD'),
+        os.path.join(common_dir, 'packed-refs'),
+    ]
+    for root, _, _ in os.walk(os.path.join(common_dir, 'refs/tags')):
+        paths.append(root)
+
+    git_mtime = 0
+    for path in paths:
+        try:
+            git_mtime = max(git_mtime, os.stat(path).st_mtime)
+        except OSError:
+            pass
+    return os.stat(version_file).st_mtime < git_mtime
+
+#------------------------------------------------------------------------------
+@functools.lru_cache(maxsize=1)
 def _version():
+    # allow build systems to inject the version without running git
+    version = os.environ.get('NOTMUCH_GMAIL_VERSION')
+    if version:
+        return version
+    version_file = os.path.join(HERE, 'VERSION')
+    try:
+        # avoid spawning git when the cached version is up to date
+        if not _version_file_is_stale(version_file):
+            with open(version_file, 'r') as f:
+                version = f.read()
+            return version.strip()
+    except OSError:
+        pass
     try:
         tag = _tag_from_git_describe()
         version = _tag_to_pep440_version(tag)
-        with open(os.path.join(HERE, 'VERSION'), 'w') as f:
+        with open(version_file, 'w') as f:
             f.write(version)
         return version
-    except:
+    except (OSError, ValueError, subprocess.SubprocessError):
         pass
     try:
-        with open(os.path.join(HERE, 'VERSION'), 'r') as f:
+        with open(version_file, 'r') as f:
             version = f.read()
         return version.strip()
-    except:
+    except OSError:
         pass
     try:
         return _version_from_git_archive_id()
-    except:
+    except ValueError:
         pass
 
     return 'latest'
@@ -23,24 +23,13 @@
 """
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import os
 import sys
 
-try:
-    import notmuch
-    del notmuch
-except ImportError:
-    print(' '.join('''
-    ERROR: cannot import notmuch python bindings. They cannot be installed via
-    easy_install nor pip and must be installed either manually or via your
-    distribution's package manager (e.g. apt-get install python3-notmuch).
-    '''.strip().split()), file=sys.stderr)
-    exit(1)
-
 from .config import Config
-from .gapi import GmailAPI, GAPIError
-from .maildir import Maildir
+from .errors import GAPIError
 from .util import human_size, configure_logging, PIDFile
 
 
@@ -102,6 +91,20 @@ def parse_args():
 
     return parser.parse_args()
 
+#------------------------------------------------------------------------------
+def check_notmuch():
+    try:
+        import notmuch
+        del notmuch
+    except ImportError:
+        print(' '.join('''
+        ERROR: cannot import notmuch python bindings. They cannot be installed
+        via easy_install nor pip and must be installed either manually or via
+        your distribution's package manager (e.g. apt-get install
+        python3-notmuch).
+        '''.strip().split()), file=sys.stderr)
+        exit(1)
+
 #------------------------------------------------------------------------------
 class HistoryError(Exception):
     pass
@@ -121,6 +124,10 @@ def __init__(self, l_updated, l_new,
 class NotmuchGmailSync(object):
 
     def __init__(self, config_filepath, force_reauth=False, no_browser=False):
+        # these pull notmuch and googleapiclient, only import them when
+        # actually syncing to keep --help and --defconfig fast
+        from .gapi import GmailAPI
+        from .maildir import Maildir
         self.config = Config(config_filepath)
         self.api = GmailAPI(self.config)
         self.mdir = Maildir(self.config)
@@ -170,12 +177,11 @@ def changes_full(self):
         r_new = set()
         for estimate, ids in self.api.all_ids():
             batch += 1
-            batch_new = 0
-            for i in ids:
-                r_all.add(i)
-                if i not in all_local:
-                    r_new.add(i)
-                    batch_new += 1
+            ids = set(ids)
+            new_ids = ids - all_local.keys()
+            r_all |= ids
+            r_new |= new_ids
+            batch_new = len(new_ids)
             if batch < estimate:
                 comment = 'approx. %d batches left' % (estimate - batch)
             else:
@@ -185,8 +191,14 @@ def changes_full(self):
 
         LOG.info('Looking for remote message deletions...')
         if all_local:
-            r_deleted = r_all - all_local.keys()
-            local_ids = all_local.keys() - r_deleted
+            # known locally but not listed remotely anymore
+            r_deleted = all_local.keys() - r_all
+            if r_deleted:
+                local_ids = all_local.keys() - r_deleted
+            else:
+                # nothing was deleted remotely (common case), no need to copy
+                # all local IDs into a new set
+                local_ids = all_local.keys()
         else:
             r_deleted = set()
             local_ids = set()
@@ -196,20 +208,28 @@ def changes_full(self):
         num_local = len(local_ids)
 
         counter = '[%{0}d/%{0}d]'.format(len(str(num_local)))
-        n = 0
+        log_info = LOG.isEnabledFor(logging.INFO)
+        n = unchanged = 0
         def callback(msg):
-            nonlocal n
+            nonlocal n, unchanged
             n += 1
+            # set == frozenset comparison does not need any conversion
             if all_local[msg['id']] == msg['tags']:
-                LOG.info(counter + ' message %r not changed',
-                         n, num_local, msg['id'])
+                # logging every unchanged message is too costly
+                unchanged += 1
+                if log_info and unchanged % 1000 == 0:
+                    LOG.info(counter + ' %d messages not changed',
+                             n, num_local, unchanged)
                 return
 
-            r_updated[msg['id']] = msg['tags']
-            LOG.info(counter + ' message %r new tags: %s',
-                     n, num_local, msg['id'], msg['tags'])
+            r_updated[msg['id']] = frozenset(msg['tags'])
+            if log_info:
+                LOG.info(counter + ' message %r new tags: %s',
+                         n, num_local, msg['id'], msg['tags'])
 
         self.api.get_content(local_ids, callback)
+        LOG.info('%d messages not changed, %d with new tags',
+                 unchanged, len(r_updated))
 
         history_id = self.api.history_id()
         if history_id > history_id_start:
@@ -228,24 +248,38 @@ def fetch(self, new_ids):
         LOG.info('Fetching new messages...')
 
         num_new = len(new_ids)
-        counter = '[%{0}d/%{0}d]'.format(len(str(num_new)))
+        # the total is constant, only format the current index per message
+        counter = '[{:%dd}/%d]' % (len(str(num_new)), num_new)
+        log_info = LOG.isEnabledFor(logging.INFO)
         n = 0
-        batch = {}
-        def callback(msg):
-            nonlocal n
-            n += 1
-            msg_path = self.mdir.store(msg)
-            size = human_size(msg['sizeEstimate'])
-            LOG.info(counter + ' fetched message %r %s', n, num_new, msg['id'], size)
-            batch[msg_path] = msg['tags']
-            if len(batch) == self.config.index_batch_size:
-                LOG.info('Updating index with %d new messages...', len(batch))
-                self.mdir.index(batch)
-                batch.clear()
-        self.api.get_content(new_ids, callback, fmt='raw')
-        if batch:
+        batch = []
+
+        def index_batch():
             LOG.info('Updating index with %d new messages...', len(batch))
-            self.mdir.index(batch)
+            # wait for pending writes before indexing the files
+            messages = [(f.result(), tags) for f, tags in batch]
+            # the database is only locked while indexing each batch so that
+            # other notmuch clients can write to it during the download
+            self.mdir.index(messages)
+            batch.clear()
+
+        # messages are written to disk in background threads while the next
+        # API responses are processed
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            def callback(msg):
+                nonlocal n
+                n += 1
+                if log_info:
+                    size = human_size(msg['sizeEstimate'])
+                    LOG.info('%s fetched message %r %s',
+                             counter.format(n), msg['id'], size)
+                future = executor.submit(self.mdir.store, msg)
+                batch.append((future, msg['tags']))
+                if len(batch) == self.config.index_batch_size:
+                    index_batch()
+            self.api.get_content(new_ids, callback, fmt='raw')
+            if batch:
+                index_batch()
 
     def merge(self, changes):
         LOG.info('Resolving conflicts...')
@@ -256,12 +290,14 @@ def merge(self, changes):
             if self.config.local_wins and self.config.push_local_tags:
                 LOG.info('Dropping %d remote changes (local_wins=True)',
                          len(conflicts))
-                for c in conflicts:
-                    del changes.r_updated[c]
+                changes.r_updated = {
+                    k: v for k, v in changes.r_updated.items()
+                    if k not in conflicts}
             else:
                 LOG.info('Dropping %d local changes', len(conflicts))
-                for c in conflicts:
-                    del changes.l_updated[c]
+                changes.l_updated = {
+                    k: v for k, v in changes.l_updated.items()
+                    if k not in conflicts}
 
         if self.config.push_local_tags and changes.l_updated:
             LOG.info('Pushing local tag changes...')
@@ -313,6 +349,7 @@ def main():
             print(Config.DEFAULT.strip())
             return 0
 
+        check_notmuch()
         configure_logging(args.verbose, args.logfile)
 
         sync = NotmuchGmailSync(
@@ -22,9 +22,6 @@
 import logging
 import os
 
-import notmuch
-from oauth2client.file import Storage
-
 
 LOG = logging.getLogger(__name__)
 
@@ -108,6 +105,7 @@ def __init_storage(self):
         if not os.path.exists(self.storage_file):
             open(self.storage_file, 'a+b').close()
         if self.__storage is None:
+            from oauth2client.file import Storage
             self.__storage = Storage(self.storage_file)
 
     def get_credentials(self):
@@ -154,6 +152,8 @@ def update_last_notmuch_rev(self):
         LOG.debug('Updated last_notmuch_rev=%d', rev)
 
     def notmuch_db(self):
+        # imported here so that Config.DEFAULT is usable without notmuch
+        import notmuch
         if os.path.isdir(os.path.join(self.notmuch_db_dir, '.notmuch')):
             db = notmuch.Database(self.notmuch_db_dir,
                 mode=notmuch.Database.MODE.READ_WRITE)  # @UndefinedVariable
@@ -29,16 +29,10 @@
 from oauth2client.client import OAuth2WebServerFlow
 from oauth2client.tools import ClientRedirectHandler, ClientRedirectServer
 
+from .errors import GAPIError, NoSyncError
 
-LOG = logging.getLogger(__name__)
-
-#------------------------------------------------------------------------------
-class GAPIError(Exception):
-    pass
 
-#------------------------------------------------------------------------------
-class NoSyncError(GAPIError):
-    pass
+LOG = logging.getLogger(__name__)
 
 #------------------------------------------------------------------------------
 class GmailAPI(object):
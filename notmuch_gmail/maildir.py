@@ -56,11 +56,11 @@ def _search_notmuch(self, querystring):
         with self.config.notmuch_db() as db:
             query = db.create_query(querystring)
             for notmuch_msg in query.search_messages():
+                tags = frozenset(notmuch_msg.get_tags())
+                tags -= self.config.ignore_tags
                 for f in notmuch_msg.get_filenames():
                     fname = os.path.basename(f)
                     match = self.GMAIL_MESSAGE_RE.match(fname)
-                    tags = set(notmuch_msg.get_tags())
-                    tags.difference_update(self.config.ignore_tags)
                     if match:
                         gmail_id = match.group(1)
                         gmail[gmail_id] = tags
@@ -73,18 +73,16 @@ def store(self, gmail_msg):
         filename = 'gmail.{id}:2,'.format(**gmail_msg)
 
         tmp_path = os.path.join(self.tmp_dir, filename)
-        if not os.path.isdir(self.tmp_dir):
-            os.makedirs(self.tmp_dir)
-        if not os.path.isdir(self.cur_dir):
-            os.makedirs(self.cur_dir)
+        # may be called concurrently from multiple threads
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        os.makedirs(self.cur_dir, exist_ok=True)
 
         msg_bytes = base64.urlsafe_b64decode(gmail_msg['raw'].encode('ascii'))
         with open(tmp_path, 'wb') as f:
             f.write(msg_bytes)
 
         msg_path = os.path.join(self.new_dir, filename)
-        if not os.path.isdir(self.new_dir):
-            os.makedirs(self.new_dir)
+        os.makedirs(self.new_dir, exist_ok=True)
         os.rename(tmp_path, msg_path)
 
         try:
@@ -96,8 +94,11 @@ def store(self, gmail_msg):
         return msg_path
 
     def index(self, messages):
+        # accept both {path: tags} dicts and iterables of (path, tags) pairs
+        if isinstance(messages, dict):
+            messages = messages.items()
         with self.config.notmuch_db() as db:
-            for msg_path, tags in messages.items():
+            for msg_path, tags in messages:
                 msg, _ = db.add_message(msg_path, sync_maildir_flags=False)
                 msg.freeze()
                 for tag in tags:
@@ -18,23 +18,23 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import fcntl
 import logging.config
+import math
 import os
 
 
 #------------------------------------------------------------------------------
 UNITS = ['B', 'K', 'M', 'G', 'T', 'P', 'E']
+_SCALES = [1000 ** i for i in range(len(UNITS))]
 def human_size(size):
     try:
         if size < 1000:
             return str(size)
         else:
-            u = 0
-            while size >= 1000 and u < len(UNITS):
-                size /= 1000
-                u += 1
-            return '%.1f%s' % (size, UNITS[u])
-    except:
+            u = min(int(math.log10(size) // 3), len(UNITS) - 1)
+            return '%.1f%s' % (size / _SCALES[u], UNITS[u])
+    except (TypeError, ValueError):
         return size
 
 #------------------------------------------------------------------------------
@@ -100,28 +100,53 @@ class AlreadyRunning(Exception):
 
     def __init__(self, config):
         self.filepath = os.path.join(config.status_dir, 'pidfile')
+        self.fd = None
+
+    def _other_pid(self):
+        try:
+            with open(self.filepath, 'r') as f:
+                return f.readline().strip() or 'unknown'
+        except OSError:
+            return 'unknown'
 
     def create(self):
         dirname = os.path.dirname(self.filepath)
         if not os.path.isdir(dirname):
             os.makedirs(dirname)
 
-        try:
-            with open(self.filepath, 'r') as f:
-                other_pid = int(f.readline().strip())
-            os.kill(other_pid, 0)
-        except:
-            other_pid = None
-
-        if other_pid is not None:
-            raise self.AlreadyRunning('PID=%d' % other_pid)
-
-        with open(self.filepath, 'w') as f:
-            f.write('%d\n' % os.getpid())
+        # The lock is held as long as the file descriptor is open and is
+        # released by the kernel if the process dies, so there are no stale
+        # files to clean up.
+        while True:
+            fd = os.open(self.filepath, os.O_CREAT | os.O_RDWR, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                raise self.AlreadyRunning('PID=%s' % self._other_pid())
+            # the previous owner may have unlinked the file between open()
+            # and flock(), make sure we locked the file that is on disk
+            try:
+                if os.path.samestat(os.fstat(fd), os.stat(self.filepath)):
+                    break
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+        os.ftruncate(fd, 0)
+        os.write(fd, ('%d\n' % os.getpid()).encode('ascii'))
+        self.fd = fd
 
     def close(self):
-        if os.path.isfile(self.filepath):
+        if self.fd is None:
+            return
+        # unlink while still holding the lock, see create()
+        try:
             os.unlink(self.filepath)
+        except FileNotFoundError:
+            pass
+        os.close(self.fd)
+        self.fd = None
 
     def __enter__(self):
         self.create()